@@ -0,0 +1,115 @@
+import os
+import time
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+# how often a queued request checks for a free slot, in seconds
+POLL_INTERVAL = 0.01
+
+
+class Saturated(Exception):
+	"""Raised when a lane's queue is full or a request waited in it for too long"""
+
+	def __init__(self, lane=None, retry_after=1):
+		Exception.__init__(self, "lane {} is saturated".format(lane))
+		self.lane = lane
+		self.retry_after = retry_after
+
+
+class TooExpensive(Exception):
+	"""Raised when a query runs past its lane's statement timeout. Retrying the same query won't help"""
+
+	def __init__(self, lane=None):
+		Exception.__init__(self, "query exceeded the {} lane's statement timeout".format(lane))
+		self.lane = lane
+
+
+class Lane(object):
+	"""A bounded set of query slots shared by every worker process on the host.
+
+	Slots and queue tickets are lock files so the limits hold across gunicorn workers. A request holds a
+	ticket from the moment it is admitted and a slot while its query runs. When there are no tickets left
+	the queue is full and the request is turned away straight away."""
+
+	def __init__(self, name, concurrency=1, queue_size=0, statement_timeout=0, queue_timeout=5.0, retry_after=1, lock_dir=None):
+		if concurrency < 1:
+			raise Exception("concurrency {}".format(concurrency))
+		self.name = name
+		self.concurrency = concurrency
+		self.queue_size = queue_size
+		self.statement_timeout = statement_timeout
+		self.queue_timeout = queue_timeout
+		self.retry_after = retry_after
+		self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), "imi-admission")
+		if not os.path.isdir(self.lock_dir):
+			try:
+				os.makedirs(self.lock_dir)
+			except OSError:
+				# another worker created it first
+				if not os.path.isdir(self.lock_dir):
+					raise
+
+	def _try_lock(self, kind, count):
+		"""Grab the first free lock file of a kind, returns its file descriptor or None if they are all taken"""
+		for i in range(count):
+			fd = os.open(os.path.join(self.lock_dir, "{}.{}.{}".format(self.name, kind, i)), os.O_RDWR | os.O_CREAT, 0o600)
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				return fd
+			except IOError:
+				os.close(fd)
+		return None
+
+	def _unlock(self, fd):
+		fcntl.flock(fd, fcntl.LOCK_UN)
+		os.close(fd)
+
+	def acquire(self):
+		"""Wait for a slot in this lane. Raises Saturated if the queue is full or the wait takes longer than queue_timeout"""
+		ticket = self._try_lock("ticket", self.concurrency + self.queue_size)
+		if ticket is None:
+			raise Saturated(self.name, self.retry_after)
+
+		deadline = time.time() + self.queue_timeout
+		while True:
+			slot = self._try_lock("slot", self.concurrency)
+			if slot is not None:
+				return (ticket, slot)
+			if time.time() >= deadline:
+				self._unlock(ticket)
+				raise Saturated(self.name, self.retry_after)
+			time.sleep(POLL_INTERVAL)
+
+	def release(self, held):
+		ticket, slot = held
+		self._unlock(slot)
+		self._unlock(ticket)
+
+
+class AdmissionController(object):
+	"""Send requests to the cheap or heavy lane depending on their estimated cost"""
+
+	def __init__(self, cheap, heavy, heavy_cost=1000000):
+		self.cheap = cheap
+		self.heavy = heavy
+		self.heavy_cost = heavy_cost
+
+	def longest_wait(self):
+		"""Longest a request can legitimately take in any lane, queueing plus its statement timeout, in seconds"""
+		return max(lane.queue_timeout + lane.statement_timeout / 1000.0 for lane in [self.cheap, self.heavy])
+
+	def lane_for(self, cost=0):
+		if cost >= self.heavy_cost:
+			return self.heavy
+		return self.cheap
+
+	@contextmanager
+	def admit(self, cost=0):
+		"""Hold a slot in the lane for this cost while the block runs"""
+		lane = self.lane_for(cost)
+		held = lane.acquire()
+		try:
+			yield lane
+		finally:
+			lane.release(held)
@@ -1,7 +1,20 @@
 import os
+import gc
+import time
+import tempfile
+import threading
 from flask import Flask, render_template, url_for, jsonify, g, request, make_response, current_app
 import psycopg2
+from psycopg2.extensions import QueryCanceledError
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 import imimodel
+from admission import Lane, AdmissionController, Saturated, TooExpensive
+from cache import ResultCache, FrequencySketch
+from warmup import Warmer
+from replicas import ReplicaRouter, parse_replicas
+from indexes import SicProductIndex, ProductSearchIndex
+from reference import ReferenceData
+from singleflight import SingleFlight, FlightError
 from datetime import timedelta
 from functools import update_wrapper
 
@@ -9,6 +22,50 @@ app = Flask(__name__)
 DEBUG = os.getenv('DEBUG',False)
 DATABASE_URL = os.getenv('DATABASE_URL',None)
 
+# PRELOAD=True loads reference data in the gunicorn master before it forks, see gunicorn_config.py
+PRELOAD = os.getenv('PRELOAD','False') == 'True'
+
+# each worker serves one request at a time next to WARMUP_CONCURRENCY cache warming threads, the pool needs room for all of them
+WARMUP_CONCURRENCY = int(os.getenv('WARMUP_CONCURRENCY',2))
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE',WARMUP_CONCURRENCY + 2))
+
+# how long to wait for a free pooled connection before giving up with a 503, in seconds
+DATABASE_POOL_TIMEOUT = float(os.getenv('DATABASE_POOL_TIMEOUT',5))
+
+# a request faster than this counts as the worker being warm
+FAST_REQUEST_MS = float(os.getenv('FAST_REQUEST_MS',100))
+
+# optional read replicas for point lookups and aggregations, see README
+router = ReplicaRouter(DATABASE_URL, parse_replicas(os.getenv('DATABASE_REPLICAS',None)),
+	interval=float(os.getenv('DATABASE_REPLICA_CHECK_INTERVAL',10)),
+	pool_size=DATABASE_POOL_SIZE)
+
+# demand queries are sent to a cheap or heavy lane by their estimated cost so a few big aggregations can't use up every database backend
+ADMISSION_EXPLAIN = os.getenv('ADMISSION_EXPLAIN','False') == 'True'
+admission = AdmissionController(
+	cheap=Lane("cheap",
+		concurrency=int(os.getenv('ADMISSION_CHEAP_CONCURRENCY',8)),
+		queue_size=int(os.getenv('ADMISSION_CHEAP_QUEUE',16)),
+		statement_timeout=int(os.getenv('ADMISSION_CHEAP_TIMEOUT',5000)),
+		queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT',5)),
+		retry_after=1),
+	heavy=Lane("heavy",
+		concurrency=int(os.getenv('ADMISSION_HEAVY_CONCURRENCY',2)),
+		queue_size=int(os.getenv('ADMISSION_HEAVY_QUEUE',4)),
+		statement_timeout=int(os.getenv('ADMISSION_HEAVY_TIMEOUT',30000)),
+		queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT',5)),
+		retry_after=10),
+	heavy_cost=int(os.getenv('ADMISSION_HEAVY_COST',1000000)))
+
+# gunicorn kills a worker whose request runs past WORKER_TIMEOUT seconds, see gunicorn_config.py. that drops the client and leaves
+# its query running in the database outside the lane that admitted it, so the longest a query can wait and run for, plus
+# REQUEST_OVERHEAD seconds for the validation and fingerprint queries around it, has to fit inside it
+WORKER_TIMEOUT = int(os.getenv('WORKER_TIMEOUT',60))
+REQUEST_OVERHEAD = 10
+if admission.longest_wait() + REQUEST_OVERHEAD >= WORKER_TIMEOUT:
+	raise Exception("WORKER_TIMEOUT {} is too short for the admission queue and statement timeouts, it needs to be over {}".format(
+		WORKER_TIMEOUT, admission.longest_wait() + REQUEST_OVERHEAD))
+
 
 def crossdomain(origin=None, methods=None, headers=None,
                 max_age=21600, attach_to_all=True,
@@ -54,42 +111,298 @@ def crossdomain(origin=None, methods=None, headers=None,
 
 
 
+# results are cached per model version, when the version changes the most popular requests are replayed before the new version is served
+# every worker has its own cache so CACHE_ROWS, rows across all cached results, is what bounds its memory. bigger results aren't cached
+cache = ResultCache(size=int(os.getenv('CACHE_SIZE',10000)),
+	max_rows=int(os.getenv('CACHE_ROWS',1000000)),
+	max_entry_rows=int(os.getenv('CACHE_ENTRY_ROWS',20000)))
+sketch = FrequencySketch()
+
+# identical demand queries and cache warming replays running at the same time share one execution, across the workers on this host unless COALESCE_DIR is empty
+# waiters give up in time to answer with a 503 before gunicorn kills the worker, which is after the slowest query admission control allows
+coalescer = SingleFlight(timeout=float(os.getenv('COALESCE_TIMEOUT',WORKER_TIMEOUT - REQUEST_OVERHEAD)),
+	shared_dir=os.getenv('COALESCE_DIR',os.path.join(tempfile.gettempdir(), "imi-coalesce")))
+if coalescer.timeout + REQUEST_OVERHEAD > WORKER_TIMEOUT:
+	raise Exception("COALESCE_TIMEOUT {} has to be at least {} less than WORKER_TIMEOUT {}".format(
+		coalescer.timeout, REQUEST_OVERHEAD, WORKER_TIMEOUT))
+
+# ranks a location's products in memory, rebuilt when the model version changes
+sic_index = SicProductIndex()
+
+# type-ahead search over the product catalogue, rebuilt when the model version changes
+search_index = ProductSearchIndex()
+
+# products, ratios, sic/naics and geo hierarchy for the current model version
+reference = ReferenceData()
+
+# per worker state that can't be shared across a fork, set up by init_worker
+worker = {"pid": None, "pool": None, "started": None, "first_fast_request": None}
+worker_lock = threading.Lock()
+
+
+def busy(retry_after=1):
+	response = jsonify(type="error",message="server busy, try again later",)
+	response.status_code = 503
+	response.headers['Retry-After'] = str(retry_after)
+	return response
+
+
+def invalid_argument(name):
+	response = jsonify(type="error",message="invalid {}".format(name),)
+	response.status_code = 422
+	return response
+
+
+def too_expensive():
+	response = jsonify(type="error",message="query too expensive, narrow the geo, seg or product filters",)
+	response.status_code = 422
+	return response
+
+
+def new_model():
+	"""ImiModel borrowing a connection from this worker's pool, waiting up to DATABASE_POOL_TIMEOUT for one to be free"""
+	init_worker()
+	current = reference if reference.version is not None and reference.version == warmer.version else None
+	deadline = time.time() + DATABASE_POOL_TIMEOUT
+	while True:
+		try:
+			return imimodel.ImiModel(DATABASE_URL, router=router, sic_index=sic_index, pool=worker["pool"], reference=current)
+		except PoolError:
+			# the pool doesn't wait for a connection to be returned so we have to
+			if time.time() >= deadline:
+				raise
+			time.sleep(0.01)
+
+
+def load_reference(conn, version):
+	"""Load reference data for a model version and build the in memory indexes from it"""
+	reference.load(conn, version)
+	sic_index.load(reference.sic_rows, version)
+	search_index.load(reference.product_rows, version)
+
+
+def init_worker():
+	"""Set up this process after the fork: its connection pool, and its own reference data if the master didn't preload it.
+	Called from gunicorn's post_fork hook, or by the first request without it"""
+	with worker_lock:
+		if worker["pid"] == os.getpid():
+			return
+		worker["pid"] = os.getpid()
+		worker["started"] = time.time()
+		worker["first_fast_request"] = None
+		worker["pool"] = ThreadedConnectionPool(1, DATABASE_POOL_SIZE, DATABASE_URL)
+
+	if reference.version is None:
+		db = new_model()
+		try:
+			version = db.fingerprint()
+			load_reference(db.conn, version)
+			warmer.notice(version)
+		finally:
+			db.close()
+
+
+def preload():
+	"""Load reference data in the gunicorn master so every worker inherits one copy-on-write. No connection is kept across the fork"""
+	db = imimodel.ImiModel(DATABASE_URL)
+	try:
+		version = db.fingerprint()
+		load_reference(db.conn, version)
+		warmer.notice(version)
+	finally:
+		db.close()
+	gc.collect()
+
+
+def worker_memory():
+	"""Resident and shared memory of this process in kB, shared includes pages still shared copy-on-write with the master"""
+	memory = {"rss": 0, "shared": 0}
+	try:
+		with open("/proc/self/smaps") as f:
+			for line in f:
+				if line.startswith("Rss:"):
+					memory["rss"] += int(line.split()[1])
+				elif line.startswith("Shared_Clean:") or line.startswith("Shared_Dirty:"):
+					memory["shared"] += int(line.split()[1])
+	except IOError:
+		pass
+	return memory
+
+
+warmer = Warmer(cache, sketch,
+	connect=new_model,
+	# every worker warms its own cache, demand replays go through the coalescer so each only runs once on the host
+	replay=lambda db, key, version: run_shared(db, key, version),
+	prepare=lambda db, version: load_reference(db.connection("lookup"), version),
+	keys=int(os.getenv('WARMUP_KEYS',200)),
+	concurrency=WARMUP_CONCURRENCY,
+	coverage=float(os.getenv('WARMUP_COVERAGE',0.8)),
+	interval=float(os.getenv('WARMUP_INTERVAL',30)))
+
+
+def get_db():
+	"""Borrow a database connection the first time a request needs it, requests served from memory never touch the pool"""
+	if not hasattr(g, 'db'):
+		g.db = new_model()
+	return g.db
+
+@app.errorhandler(PoolError)
+def pool_exhausted(e):
+	return busy(1)
+
 @app.before_request
 def before_request():
-	g.db = imimodel.ImiModel(DATABASE_URL)
+	init_worker()
+	g.started = time.time()
+
+@app.after_request
+def after_request(response):
+	if worker["first_fast_request"] is None and request.endpoint != 'ready' and response.status_code < 400:
+		if (time.time() - g.started) * 1000 < FAST_REQUEST_MS:
+			worker["first_fast_request"] = time.time() - worker["started"]
+			memory = worker_memory()
+			app.logger.info("worker {} first fast request {:.3f}s after start, rss {} kB, shared {} kB".format(
+				worker["pid"], worker["first_fast_request"], memory["rss"], memory["shared"]))
+	return response
 
 @app.teardown_request
 def teardown_request(exception):
-    g.db.close()
+	if hasattr(g, 'db'):
+		g.db.close()
 
 @app.route('/')
 def hello():
     return render_template('index.html', database=DATABASE_URL)
 
+
+def normalize_list(value):
+	"""Turn a comma separated query argument into a sorted tuple so equivalent requests share a cache key"""
+	if value is None or value == 'None':
+		return None
+	return tuple(sorted(set(value.split(","))))
+
+
+def run_request(db, key):
+	"""Run the query for a normalized request key. Used for cache misses and for replaying requests when warming the cache"""
+	kind = key[0]
+	if kind == "product":
+		return db.product(key[1])
+	elif kind == "products":
+		products = db.product_list(category=key[1])
+		to_return = []
+		for p in products['results']:
+			to_return.append({
+				"productId":p[0],
+				"description":p[1],
+				"type":p[2],
+				"category":p[3],
+				"extended":p[4]
+				})
+		return {"products": to_return}
+	elif kind in ["demand", "drilldown"]:
+		group_by, geo_filter, products = key[1], key[2], list(key[3] or [])
+		seg_filter = ",".join(key[4]) if key[4] else None
+		levels = None
+		if kind == "drilldown":
+			# a drill-down costs about as much as grouping by its smallest level, levels are already ordered largest to smallest
+			levels = list(key[1])
+			group_by = levels[-1]
+		cost = db.demand_cost(group_by=group_by,geo_filter=geo_filter,seg_filter=seg_filter,products=products,explain=ADMISSION_EXPLAIN)
+		lane = admission.lane_for(cost)
+		with admission.admit(cost):
+			try:
+				db.set_statement_timeout(lane.statement_timeout)
+				if kind == "drilldown":
+					return db.demand_drilldown(levels=levels,geo_filter=geo_filter,seg_filter=seg_filter,products=products)
+				return db.demand(group_by=group_by,geo_filter=geo_filter,seg_filter=seg_filter,products=products)
+			except QueryCanceledError:
+				db.rollback()
+				raise TooExpensive(lane.name)
+	elif kind == "location":
+		if key[2] is None:
+			return db.location_demand(duns=key[1],limit=key[3])
+		return db.location_demand(duns=key[1],products=list(key[2]),limit=key[3])
+	raise Exception("request {}".format(key))
+
+
+def cached(key):
+	"""Return the result for a request key from the cache, running it against the database on a miss"""
+	sketch.add(key)
+	result = cache.get(key)
+	if result is not None:
+		warmer.poll(get_db)
+		return result
+
+	db = get_db()
+	version = db.fingerprint()
+	warmer.notice(version)
+	result = run_shared(db, key, version)
+	cache.put(version, key, result)
+	return result
+
+
+def run_shared(db, key, version):
+	"""Run a request key, sharing one execution between identical demand queries running at the same time. Lookups are cheap enough to run directly"""
+	if key[0] in ["demand", "drilldown"]:
+		return coalescer.do((version,) + key, lambda: run_request(db, key))
+	return run_request(db, key)
+
+
+@app.route('/ready')
+def ready():
+	warm = worker["pool"] is not None and reference.version is not None and \
+		sic_index.version == reference.version and search_index.version == reference.version
+	response = jsonify(
+		ready=warm,
+		pid=os.getpid(),
+		preloaded=PRELOAD,
+		version=reference.version,
+		uptime=time.time() - worker["started"],
+		firstFastRequest=worker["first_fast_request"],
+		memory=worker_memory())
+	if not warm:
+		response.status_code = 503
+	return response
+
+
 @app.route('/1/products')
 @app.route('/1/products/<product_id>')
 @crossdomain(origin='*')
 def products(product_id=None):
 	if product_id:
-		product = g.db.product(product_id)
-		return jsonify(product)
-	elif request.args.get('category', None):
-		products = g.db.product_list(category=request.args.get('category', None))
-	else:		
-		products = g.db.product_list()
+		return jsonify(cached(("product", product_id)))
+	return jsonify(cached(("products", request.args.get('category', None))))
 
-	to_return = []
-	for p in products['results']:
-		to_return.append({
-			"productId":p[0],
-			"description":p[1],
-			"type":p[2],
-			"category":p[3],
-			"extended":p[4]
-			})
 
+@app.route('/1/products/search')
+@crossdomain(origin='*')
+def product_search():
+	q = request.args.get('q', '')
+	try:
+		limit = max(1, min(int(request.args.get('limit', 10)), 100))
+	except ValueError:
+		return invalid_argument("limit")
+	version = warmer.poll(get_db)
+	if version != search_index.version:
+		search_index.ensure(get_db().connection("lookup"), version)
+	return jsonify(products=search_index.search(q, limit=limit))
 
-	return jsonify(products=to_return)
+
+def run_demand(key):
+	"""Answer a demand or drill-down request key, turning admission control and coalescing failures into their responses"""
+	try:
+		result = cached(key)
+	except Saturated as e:
+		return busy(e.retry_after)
+	except TooExpensive:
+		return too_expensive()
+	except FlightError as e:
+		if e.kind == "TooExpensive":
+			return too_expensive()
+		if e.retry_after is None:
+			raise
+		return busy(e.retry_after)
+	return jsonify(result)
 
 
 @app.route('/1/demand')
@@ -98,28 +411,54 @@ def demand():
 	group_by=str(request.args.get('group_by', None))
 	products=str(request.args.get('products', None))
 	geo_filter=str(request.args.get('geo', None))
-	products = products.split(",")
-	result = g.db.demand(group_by=group_by,geo_filter=str(geo_filter),products=products)
-	return jsonify(result)
+	seg_filter=str(request.args.get('seg', None))
+	return run_demand(("demand", group_by, ",".join(normalize_list(geo_filter) or ['None']), normalize_list(products), normalize_list(seg_filter)))
+
+
+@app.route('/1/demand/drilldown')
+@crossdomain(origin='*')
+def demand_drilldown():
+	levels=str(request.args.get('levels', 'nation,state,county'))
+	products=str(request.args.get('products', None))
+	geo_filter=str(request.args.get('geo', None))
+	seg_filter=str(request.args.get('seg', None))
+	# the same levels in any order are the same drill-down, keep them largest to smallest
+	names = [l[0] for l in imimodel.DRILLDOWN_LEVELS]
+	requested = levels.split(",")
+	if any(level not in names for level in requested):
+		return invalid_argument("levels")
+	levels = tuple(name for name in names if name in requested)
+	return run_demand(("drilldown", levels, ",".join(normalize_list(geo_filter) or ['None']), normalize_list(products), normalize_list(seg_filter)))
 
 
 @app.route('/1/location/<duns>')
 @crossdomain(origin='*')
 def location(duns=None):
 	products=str(request.args.get('products', None))
+	limit = request.args.get('limit', None)
+	if limit is not None:
+		try:
+			limit = int(limit)
+		except ValueError:
+			return invalid_argument("limit")
+		if limit < 1:
+			return invalid_argument("limit")
 	try: 
-		if products == 'None':
-			result = g.db.location_demand(duns=duns)
-		else:
-			products = products.split(",")
-			result = g.db.location_demand(duns=duns,products=products)
+		result = cached(("location", duns, normalize_list(products), limit))
 		return jsonify(result)
+	except PoolError:
+		# not the duns number's fault, let pool_exhausted answer with a 503
+		raise
 	except:
 		response = jsonify(type="error",message="invalid duns number",)
 		response.status_code = 422
 		return response
 
 
+if PRELOAD:
+	preload()
+
+
 if __name__ == '__main__':
 	print "local"
 	app.run(debug=DEBUG)
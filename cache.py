@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+
+
+class FrequencySketch(object):
+	"""Count-min sketch of how often each request key is seen, plus the most popular keys themselves.
+
+	Counters are halved every sample_size additions so the counts favour recent traffic."""
+
+	def __init__(self, width=4096, depth=4, capacity=500, sample_size=100000):
+		self.width = width
+		self.depth = depth
+		self.capacity = capacity
+		self.sample_size = sample_size
+		self.table = [[0] * width for i in range(depth)]
+		self.additions = 0
+		# the most popular keys we know about and their estimated counts
+		self.candidates = {}
+		self.lock = threading.Lock()
+
+	def _cells(self, key):
+		return [hash((i, key)) % self.width for i in range(self.depth)]
+
+	def estimate(self, key):
+		with self.lock:
+			return self._estimate(key)
+
+	def _estimate(self, key):
+		return min(self.table[i][c] for i, c in enumerate(self._cells(key)))
+
+	def add(self, key):
+		with self.lock:
+			for i, c in enumerate(self._cells(key)):
+				self.table[i][c] += 1
+			count = self._estimate(key)
+
+			if key in self.candidates or len(self.candidates) < self.capacity:
+				self.candidates[key] = count
+			else:
+				least = min(self.candidates, key=self.candidates.get)
+				if count > self.candidates[least]:
+					del self.candidates[least]
+					self.candidates[key] = count
+
+			self.additions += 1
+			if self.additions >= self.sample_size:
+				self._age()
+
+	def _age(self):
+		self.additions = 0
+		for row in self.table:
+			for c in range(self.width):
+				row[c] >>= 1
+		for key in list(self.candidates):
+			self.candidates[key] >>= 1
+			if self.candidates[key] == 0:
+				del self.candidates[key]
+
+	def top(self, n=100):
+		"""Return the n most popular keys as (key, count) pairs, most popular first"""
+		with self.lock:
+			ranked = sorted(self.candidates.items(), key=lambda kv: kv[1], reverse=True)
+		return ranked[:n]
+
+
+def result_rows(value):
+	"""Rough size of a result, the number of items in all of its lists"""
+	if isinstance(value, dict):
+		return sum(result_rows(v) for v in value.values())
+	if isinstance(value, (list, tuple)):
+		return len(value) + sum(result_rows(v) for v in value if isinstance(v, (dict, list, tuple)))
+	return 0
+
+
+class ResultCache(object):
+	"""Results keyed by request, kept separately for each model version.
+
+	The active version is served first. Results for the version being warmed are collected alongside it
+	and only served for keys the active version doesn't have, until the new version is promoted and the
+	old one dropped. Results for any other version are ignored.
+
+	Memory is bounded by rows as well as entries: results over max_entry_rows aren't cached at all, and
+	the least recently used entries are evicted while both versions together hold more than max_rows."""
+
+	def __init__(self, size=10000, max_rows=1000000, max_entry_rows=20000):
+		self.size = size
+		self.max_rows = max_rows
+		self.max_entry_rows = max_entry_rows
+		self.rows = 0
+		self.versions = {}
+		self.active = None
+		self.warming = None
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			for version in [self.active, self.warming]:
+				entries = self.versions.get(version)
+				if entries is not None and key in entries:
+					# move to the end so it is the last to be evicted
+					value, rows = entries.pop(key)
+					entries[key] = (value, rows)
+					return value
+			return None
+
+	def has(self, version, key):
+		with self.lock:
+			return key in self.versions.get(version, {})
+
+	def put(self, version, key, value):
+		rows = result_rows(value)
+		with self.lock:
+			if self.active is None:
+				self.active = version
+			if version not in [self.active, self.warming] or rows > self.max_entry_rows:
+				return
+			entries = self.versions.setdefault(version, OrderedDict())
+			if key in entries:
+				self.rows -= entries.pop(key)[1]
+			entries[key] = (value, rows)
+			self.rows += rows
+			while entries and (len(entries) > self.size or self.rows > self.max_rows):
+				self.rows -= entries.popitem(last=False)[1][1]
+
+	def _drop(self, version):
+		for value, rows in self.versions.pop(version, {}).values():
+			self.rows -= rows
+
+	def warm(self, version):
+		"""Start collecting results for version alongside the active one"""
+		with self.lock:
+			if version != self.active:
+				if self.warming is not None:
+					self._drop(self.warming)
+				self.warming = version
+
+	def promote(self, version):
+		"""Start serving results for version and drop the previously active one"""
+		with self.lock:
+			if version == self.active:
+				return
+			if self.active is not None:
+				self._drop(self.active)
+			if version == self.warming:
+				self.warming = None
+			self.active = version
@@ -0,0 +1,13 @@
+import os
+
+# load reference data in the master before forking so workers share it copy-on-write, see app.preload
+preload_app = os.getenv('PRELOAD','False') == 'True'
+workers = int(os.getenv('WEB_CONCURRENCY',1))
+
+# a sync worker busy on one request for longer than this is killed, app.py checks the admission timeouts fit inside it
+timeout = int(os.getenv('WORKER_TIMEOUT',60))
+
+def post_fork(server, worker):
+	# connection pools and other per process state have to be created after the fork
+	import app
+	app.init_worker()
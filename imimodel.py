@@ -1,23 +1,112 @@
 import psycopg2
+from psycopg2.pool import PoolError
 from operator import itemgetter
 from datetime import datetime
 import os
 import shutil
 import subprocess
 from decimal import *
+import replicas
+
+# rough row counts of the locations_{extent} rollup tables and the full locations table, used to estimate query cost when
+# the reference data has no planner statistics for them
+EXTENT_ROWS = {"nation": 50000, "region": 200000, "state": 600000, "msa": 1500000, "county": 2500000, "postal code": 6000000, "postal_code": 6000000}
+LOCATION_ROWS = 15000000
+
+# fraction of a table selected by a single geo filter at each level, when the reference data doesn't know how many places the level has
+GEO_SELECTIVITY = {"nation": 1.0, "region": 0.1, "state": 0.02, "msa": 0.005, "county": 0.0005, "postal code": 0.00005, "postal_code": 0.00005}
+
+# fraction of a table selected by each sic/naics filter and each product
+SEG_SELECTIVITY = 0.05
+PRODUCT_SELECTIVITY = 0.05
+
+# grouping by many small groups (or returning companies sorted by demand) costs more than the scan alone
+GROUP_BY_WEIGHT = {"company": 2.0, "postal code": 1.5, "postal_code": 1.5, "county": 1.2}
+
+# geographic levels a demand drill-down can return from largest to smallest, with the columns that identify a place at each level and their names in the response
+DRILLDOWN_LEVELS = [
+	("nation", ["g.nation"], ["name"]),
+	("region", ["g.region"], ["name"]),
+	("state", ["g.state", "g.state_abbrev"], ["name", "abbrev"]),
+	("county", ["g.county", "lpad(g.state_fips,2,'0') || lpad(g.county_fips,3,'0')"], ["name", "fips"]),
+	("postal_code", ["g.postal_code"], ["name"]),
+]
 
 class ImiModel(object):
 
-	def __init__(self, database_url=None):
-		if not database_url:
+	def __init__(self, database_url=None, router=None, sic_index=None, pool=None, reference=None):
+		if not database_url and not pool:
 			raise Exception("database_url is required")		
-		self.conn = psycopg2.connect(database_url)
+
+		# with a psycopg2 pool the primary connection is borrowed for the life of this object and returned by close()
+		self.pool = pool
+		if pool:
+			self.conn = pool.getconn()
+		else:
+			self.conn = psycopg2.connect(database_url)
+
+		# optional ReplicaRouter, point lookups and aggregations can then be sent to read replicas
+		self.router = router
+		self.connections = {}
+		self.replica_urls = {}
+
+		# model version of the primary, read once by fingerprint()
+		self.version = None
+
+		# optional SicProductIndex used to rank a location's products without querying ratios
+		self.sic_index = sic_index
+
+		# optional ReferenceData for the current model version, used to skip validation queries
+		self.reference = reference
 
 		# list of the different geographic extents we can use to group data from largest to smallest
 		self.group_by = ["nation","region","state","msa","county","postal code", "postal_code", "sic","naics","company", "company_size" ]
 
 	def close(self):
-		self.conn.close()
+		"""Return every borrowed connection, even if returning one of them fails, then raise the first failure"""
+		error = None
+		for query_class, conn in self.connections.items():
+			if conn is not self.conn:
+				try:
+					self.router.putconn(self.replica_urls[query_class], conn)
+				except Exception as e:
+					error = error or e
+		self.connections = {}
+		if self.pool:
+			# don't hand an open transaction (or its statement timeout) to the next user
+			replicas.putconn(self.pool, self.conn)
+		else:
+			self.conn.close()
+		if error:
+			raise error
+
+	def connection(self, query_class=None ):
+		"""Return the connection to use for a class of query ("lookup" or "aggregation"), borrowing a replica connection the first time.
+		A replica is only used if the router's last check found it on the model version the primary has now, otherwise the primary is used."""
+		if query_class in self.connections:
+			return self.connections[query_class]
+
+		conn = self.conn
+		url = self.router.choose(query_class) if self.router else None
+		if url and self.router.replica_version(url) == self.fingerprint():
+			try:
+				conn = self.router.getconn(url)
+				self.replica_urls[query_class] = url
+			except PoolError:
+				# every connection to this replica is in use, the primary will do
+				pass
+			except psycopg2.Error:
+				self.router.mark_unhealthy(url)
+
+		self.connections[query_class] = conn
+		return conn
+
+	def rollback(self):
+		"""Roll back the open transaction on every connection, needed after a query is cancelled"""
+		self.conn.rollback()
+		for conn in self.connections.values():
+			if conn is not self.conn:
+				conn.rollback()
 
 	def valid_group_by(self, group_by=None ):
 		return group_by in self.group_by
@@ -36,6 +125,8 @@ class ImiModel(object):
 		if products and len(products) > 0: 
 			all_good = True
 			for p in products:
+				if self.reference and self.reference.has_product(p):
+					continue
 				cur = self.conn.cursor()
 				cur.execute("""select 
 					*
@@ -91,6 +182,8 @@ class ImiModel(object):
 			if f is None:
 				all_good = False
 				break
+			if self.reference and self.reference.has_geo(g):
+				continue
 
 			cur.execute("""select * from geo g where ({}) limit 1""".format(f) )
 			row = cur.fetchone()
@@ -194,6 +287,8 @@ class ImiModel(object):
 
 			if f is None or f == "" or not f:
 				continue
+			if self.reference and ":" not in f and self.reference.has_seg(seg_type, f):
+				continue
 
 			filter_query = None
 			cur = self.conn.cursor()
@@ -244,17 +339,11 @@ class ImiModel(object):
 
 
 
-	def min_extent( self, geo_filter=None ):
-		"""Given a geo filter return the extent which would contain the smallest level (most detailed) geo filter"""
-		if not self.valid_geo_filter(geo_filter):
-			raise Exception("geo_filter {}".format(geo_filter))
-
-		if type(geo_filter) == type(""):
-			geo_filter = self.geo_filter_string_to_array(geo_filter)
-
+	def geo_filter_level( self, geo=None ):
+		"""Given the keys used by one or more geo filters return the smallest level (most detailed) they refer to. Does not validate the filter."""
 		extents = []
-		for geo in geo_filter:
-			for h in geo:
+		for g in geo or []:
+			for h in g:
 				if h not in extents:
 					extents.append(h)
 
@@ -273,6 +362,35 @@ class ImiModel(object):
 		else:
 			return "nation"
 
+	def min_extent( self, geo_filter=None ):
+		"""Given a geo filter return the extent which would contain the smallest level (most detailed) geo filter"""
+		if not self.valid_geo_filter(geo_filter):
+			raise Exception("geo_filter {}".format(geo_filter))
+
+		if type(geo_filter) == type(""):
+			geo_filter = self.geo_filter_string_to_array(geo_filter)
+
+		return self.geo_filter_level(geo_filter)
+
+	def demand_extent( self, group_by=None, geo_filter=None ):
+		"""Pick the locations_/geo_ extent tables a demand query has to read for a group by and geo filter"""
+
+		# there are cases where the geo filter requires the min extent table rather than the group by table. if you want to group by msa by filter by specific counties for example
+		extent = self.min_extent( geo_filter )
+
+		if extent == "nation" and group_by in ["region","state","msa","county","postal code", "postal_code"]:
+			extent = group_by
+		elif extent == "region" and group_by in ["state","msa","county","postal code", "postal_code"]:			
+			extent = group_by
+		elif extent == "state" and group_by in ["msa","county","postal code", "postal_code"]:			
+			extent = group_by
+		elif extent == "msa" and group_by in ["county","postal code", "postal_code"]:			
+			extent = group_by
+		elif extent == "county" and group_by in ["postal code", "postal_code"]:			
+			extent = group_by
+
+		return extent
+
 
 
 	def build_geo_filter_where_query( self, geo_filter=None ):
@@ -330,12 +448,14 @@ class ImiModel(object):
 
 
 	def fingerprint( self  ):
-		"""return the GIT version number of the model from the database used as a fingerprint to tell which version data comes from"""
-		cur = self.conn.cursor()
-		cur.execute("select version from version;")
-		version = cur.fetchone()[0]
-		cur.close()
-		return version
+		"""return the GIT version number of the model from the database used as a fingerprint to tell which version data comes from.
+		Only read from the database once per ImiModel"""
+		if self.version is None:
+			cur = self.conn.cursor()
+			cur.execute("select version from version;")
+			self.version = cur.fetchone()[0]
+			cur.close()
+		return self.version
 
 
 		# build the geo part of the where query
@@ -371,8 +491,8 @@ class ImiModel(object):
 		return words
 
 
-	def demand( self, group_by=None, geo_filter=None, seg_filter=None, products=None, limit=100  ):
-		"""Show demand and employee count totals for given inputs"""
+	def demand_query( self, group_by=None, geo_filter=None, seg_filter=None, products=None, limit=100  ):
+		"""Validate demand inputs and build the sql, parameters and header for the demand query"""
 		if not self.valid_group_by(group_by):
 			raise Exception("group_by {}".format(group_by))
 		if not self.valid_geo_filter(geo_filter):
@@ -413,23 +533,10 @@ class ImiModel(object):
 			geo_columns = "l.company_size"
 			header = [ "companySize" ] 
 
-		# there are cases where the geo filter requires the min extent table rather than the group by table. if you want to group by msa by filter by specific counties for example
-		extent = self.min_extent( geo_filter )
+		extent = self.demand_extent( group_by, geo_filter )
 
-		if extent == "nation" and group_by in ["region","state","msa","county","postal code", "postal_code"]:
-			extent = group_by
-		elif extent == "region" and group_by in ["state","msa","county","postal code", "postal_code"]:			
-			extent = group_by
-		elif extent == "state" and group_by in ["msa","county","postal code", "postal_code"]:			
-			extent = group_by
-		elif extent == "msa" and group_by in ["county","postal code", "postal_code"]:			
-			extent = group_by
-		elif extent == "county" and group_by in ["postal code", "postal_code"]:			
-			extent = group_by
-
-		cur = self.conn.cursor()
 		if group_by == 'company':
-			cur.execute( """
+			query = """
 			select
 			l.duns, l.name, l.url, l.employees, l.sic, s.description, l.naics, n.description,
 			l.sales, g.nation, g.region, g.state, g.msa, g.county, g.postal_code, l.lon, l.lat,
@@ -446,7 +553,7 @@ class ImiModel(object):
 			where ({}) and ({})
 			order by demand desc
 			limit {}
-			""".format(geo_query,seg_query,limit), (products,))
+			""".format(geo_query,seg_query,limit)
 
 			header = ["duns","name","url","employees","sic","sicDescription", "naics", "naicsDescription", "sales", "country","region","state","msa","county","postalCode","longitude","latitude", "Demand" ]
 		else:
@@ -468,7 +575,7 @@ class ImiModel(object):
 				order by demand desc
 				'''.format(geo_columns,geo_query,seg_query,geo_columns), (products,))
 			"""
-			cur.execute('''
+			query = '''
 				select 
 				{},
 				round(sum(l.employees*r.ratio)) as demand,
@@ -484,7 +591,16 @@ class ImiModel(object):
 				where ({}) and ({})
 				group by {}
 				order by demand desc
-				'''.format(geo_columns,extent,extent,geo_query,seg_query,geo_columns), (products,))
+				'''.format(geo_columns,extent,extent,geo_query,seg_query,geo_columns)
+
+		return query, (products,), header
+
+	def demand( self, group_by=None, geo_filter=None, seg_filter=None, products=None, limit=100  ):
+		"""Show demand and employee count totals for given inputs"""
+		query, params, header = self.demand_query(group_by=group_by, geo_filter=geo_filter, seg_filter=seg_filter, products=products, limit=limit)
+
+		cur = self.connection("aggregation").cursor()
+		cur.execute(query, params)
 
 		results = []
 		total_demand = 0
@@ -517,6 +633,149 @@ class ImiModel(object):
 
 
 
+	def demand_drilldown( self, levels=None, geo_filter=None, seg_filter=None, products=None ):
+		"""Show demand and company totals for several geographic levels at once, nested largest to smallest.
+		Runs a single query grouped by the smallest level and rolls the totals up to the larger ones."""
+		names = [l[0] for l in DRILLDOWN_LEVELS]
+		if not levels or any(level not in names for level in levels):
+			raise Exception("levels {}".format(levels))
+		if not self.valid_geo_filter(geo_filter):
+			raise Exception("geo_filter {}".format(geo_filter))
+		if not self.valid_products(products):
+			raise Exception("products {}".format(products))
+		if not self.valid_seg_filter(seg_filter):
+			raise Exception("seg_filter {}".format(seg_filter))
+
+		levels = [l for l in names if l in levels]
+		finest = names.index(levels[-1])
+
+		# group by every level down to the smallest requested one so each place is identified by its full path
+		columns = []
+		offsets = []
+		for name, level_columns, keys in DRILLDOWN_LEVELS[:finest + 1]:
+			offsets.append(len(columns))
+			columns += level_columns
+
+		geo_query = self.build_geo_filter_where_query(geo_filter=geo_filter)
+		seg_query = self.build_seg_filter_where_query(seg_filter=seg_filter)
+		extent = self.demand_extent( levels[-1], geo_filter )
+
+		cur = self.connection("aggregation").cursor()
+		cur.execute('''
+			select 
+			{},
+			sum(l.employees*r.ratio) as demand,
+			sum(companies) as companies
+			from locations_{} l
+			inner join (select sic, sum(ratio) as ratio
+			from ratios r 
+			where product_id=ANY(%s)
+			group by sic) as r on r.sic=l.sic
+			inner join geo_{} g on g.id=l.geo_id
+			where ({}) and ({})
+			group by {}
+			'''.format(",".join(columns),extent,extent,geo_query,seg_query,",".join(columns)), (products,))
+
+		# roll each row up into its place at every requested level
+		root = {"demand": 0, "companies": 0, "children": {}}
+		for row in cur:
+			node = root
+			node["demand"] += row[-2] or 0
+			node["companies"] += int(row[-1] or 0)
+			for level in levels:
+				i = names.index(level)
+				end = offsets[i] + len(DRILLDOWN_LEVELS[i][1])
+				path = tuple(row[:end])
+				if path not in node["children"]:
+					child = {"level": level, "demand": 0, "companies": 0, "children": {}}
+					for key, value in zip(DRILLDOWN_LEVELS[i][2], row[offsets[i]:end]):
+						child[key] = value
+					node["children"][path] = child
+				node = node["children"][path]
+				node["demand"] += row[-2] or 0
+				node["companies"] += int(row[-1] or 0)
+		cur.close()
+
+		def finish(node):
+			node["demand"] = int(round(node["demand"]))
+			children = sorted(node["children"].values(), key=lambda c: c["demand"], reverse=True)
+			node["children"] = [finish(c) for c in children]
+			return node
+
+		to_return = finish(root)
+		to_return["levels"] = levels
+		return to_return
+
+	def demand_cost( self, group_by=None, geo_filter=None, seg_filter=None, products=None, explain=False ):
+		"""Estimate how many rows a demand query will have to read. Used to decide which admission lane a request goes to."""
+		if not self.valid_group_by(group_by):
+			raise Exception("group_by {}".format(group_by))
+
+		if type(products) == str:
+			products = [products]
+		if type(geo_filter) == type(""):
+			geo_filter = self.geo_filter_string_to_array(geo_filter)
+		if type(seg_filter) == type(""):
+			seg_filter = self.seg_filter_string_to_array(seg_filter)
+
+		if explain:
+			# let the planner estimate it, the largest row count of any node in the plan is roughly how much work the query is
+			query, params, header = self.demand_query(group_by=group_by, geo_filter=geo_filter, seg_filter=seg_filter, products=products)
+			cur = self.connection("aggregation").cursor()
+			cur.execute("explain " + query, params)
+			rows = 0
+			for row in cur:
+				for part in row[0].split("rows=")[1:]:
+					rows = max(rows, int(part.split(" ")[0]))
+			cur.close()
+			return rows
+
+		extent = self.demand_extent( group_by, geo_filter )
+		if group_by == "company":
+			rows = self.table_rows("locations")
+		else:
+			rows = self.table_rows("locations_" + extent)
+
+		# each geo filter selects a slice of the extent table, several filters are or'ed together
+		if geo_filter and geo_filter != [{}]:
+			selectivity = 0.0
+			for g in geo_filter:
+				selectivity += self.geo_selectivity(self.geo_filter_level([g]))
+			rows *= min(1.0, selectivity)
+
+		if type(seg_filter) == type({}) and seg_filter.get("filter"):
+			seg = seg_filter["filter"]
+			if type(seg) == type(""):
+				seg = [seg]
+			rows *= min(1.0, SEG_SELECTIVITY * len(seg))
+
+		# more products means more matching sics in the ratios join
+		rows *= min(1.0, PRODUCT_SELECTIVITY * len(products or []))
+
+		return int(rows * GROUP_BY_WEIGHT.get(group_by, 1.0))
+
+	def table_rows( self, table ):
+		"""Estimated row count of locations or a locations_{extent} table, from the planner statistics the reference data read for this model version if it has them"""
+		if self.reference and self.reference.table_rows.get(table):
+			return self.reference.table_rows[table]
+		if table == "locations":
+			return LOCATION_ROWS
+		return EXTENT_ROWS.get(table[len("locations_"):], LOCATION_ROWS)
+
+	def geo_selectivity( self, level ):
+		"""Fraction of a table a single geo filter at a level selects, one place out of all of that level's places in the nation"""
+		if self.reference and self.reference.places.get(level) and self.reference.places.get("nation"):
+			return float(self.reference.places["nation"]) / self.reference.places[level]
+		return GEO_SELECTIVITY[level]
+
+	def set_statement_timeout( self, timeout=None ):
+		"""Limit how long queries on the primary and aggregation connections may run for, in milliseconds, until the end of the transaction. 0 or None disables the limit."""
+		for conn in set([self.conn, self.connection("aggregation")]):
+			cur = conn.cursor()
+			cur.execute("set local statement_timeout = %s", (int(timeout or 0),))
+			cur.close()
+
+
 	def demographics( self, geo_filter=None, seg_filter=None, products=None  ):
 		"""Show company counts totals for by consuming sic"""
 		if not self.valid_geo_filter(geo_filter):
@@ -531,7 +790,7 @@ class ImiModel(object):
 		seg_query = self.build_seg_filter_where_query(seg_filter=seg_filter)
 		extent = self.min_extent( geo_filter )
 
-		cur = self.conn.cursor()
+		cur = self.connection("aggregation").cursor()
 		'''cur.execute("""
 				select 
 				l.company_size,
@@ -583,21 +842,22 @@ class ImiModel(object):
 		return to_return
 
 
-	def location_demand( self, duns=None, products=None ):
-		"""estimate demand for a location"""
+	def location_demand( self, duns=None, products=None, limit=None ):
+		"""estimate demand for a location, limit keeps only the top products"""
 		if not self.valid_duns(duns):
 			raise Exception("duns {}".format(duns))
 		if products:
 			if not self.valid_products(products):
 				raise Exception("products {}".format(products))
 
-		cur = self.conn.cursor()
+		cur = self.connection("lookup").cursor()
 
 		#check that the duns number exists and is valid
 		cur.execute( """
 		select
 		l.duns, l.name, l.url, l.employees, l.sic, s.description, l.naics, n.description,
-		l.sales, g.nation, g.region, g.state, g.msa, g.county, g.postal_code, l.lon, l.lat
+		l.sales, g.nation, g.region, g.state, g.msa, g.county, g.postal_code, l.lon, l.lat,
+		(select version from version) as version
 		from
 		locations l
 		inner join geo g on g.id=l.geo_id
@@ -632,7 +892,14 @@ class ImiModel(object):
 		}
 
 
-		if products:
+		limit_query = ""
+		if limit:
+			limit_query = "limit {}".format(int(limit))
+
+		if self.sic_index:
+			self.sic_index.ensure(self.connection("lookup"), result[17])
+			rows = self.sic_index.products(result[4], result[3], products=products or None, limit=limit)
+		elif products:
 			cur.execute("""
 				select r.product_id, p.description, r.ratio*l.employees as demand from locations l
 				inner join ratios r on r.sic=l.sic
@@ -641,7 +908,9 @@ class ImiModel(object):
 				inner join geo g on g.id=l.geo_id
 				where duns=%s
 				and p.product_id=ANY(%s)
-				order by demand desc;""",(duns,products) )
+				order by demand desc
+				{};""".format(limit_query),(duns,products) )
+			rows = cur
 		else:
 			cur.execute("""
 				select r.product_id, p.description, r.ratio*l.employees as demand from locations l
@@ -650,11 +919,13 @@ class ImiModel(object):
 				inner join sic s on s.sic=l.sic
 				inner join geo g on g.id=l.geo_id
 				where duns=%s
-				order by demand desc;""",(duns,) )
+				order by demand desc
+				{};""".format(limit_query),(duns,) )
+			rows = cur
 
 		products = []
 		demand = 0
-		for row in cur:
+		for row in rows:
 			products.append({
 				"product_id": row[0],
 				"description": row[1],
@@ -669,7 +940,7 @@ class ImiModel(object):
 
 
 	def product_list( self, category=None ):
-		cur = self.conn.cursor()
+		cur = self.connection("lookup").cursor()
 
 		results = []
 		if category:
@@ -701,7 +972,7 @@ class ImiModel(object):
 		if not self.valid_products([product_id]):
 			raise Exception("products {}".format([product]))
 
-		cur = self.conn.cursor()
+		cur = self.connection("lookup").cursor()
 
 		product = {}
 
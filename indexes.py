@@ -0,0 +1,203 @@
+import heapq
+import threading
+
+
+class SicProductIndex(object):
+	"""In memory index from sic to the products it consumes, sorted by ratio with their descriptions.
+
+	A location's product demand is ratio * employees so the ranking only depends on its sic. Looking up
+	a location is then one primary key fetch plus a scan of a presorted list. The index is rebuilt
+	whenever it is asked for a different model version than the one it was built from."""
+
+	# (sic, product_id, description, ratio) for every product a sic consumes
+	query = """
+		select r.sic, r.product_id, p.description, r.ratio
+		from ratios r
+		inner join products p on p.product_id=r.product_id
+		inner join sic s on s.sic=r.sic
+		order by r.sic, r.ratio desc
+		"""
+
+	def __init__(self):
+		self.version = None
+		self.sics = {}
+		self.lock = threading.Lock()
+
+	def build(self, conn, version):
+		cur = conn.cursor()
+		cur.execute(SicProductIndex.query)
+		self.load(cur, version)
+		cur.close()
+
+	def load(self, rows, version):
+		"""Build the index from rows returned by query"""
+		sics = {}
+		for row in rows:
+			sics.setdefault(row[0], []).append((row[1], row[2], row[3]))
+
+		self.sics = sics
+		self.version = version
+
+	def ensure(self, conn, version):
+		"""Rebuild the index from conn if it was built from a different model version"""
+		if version == self.version:
+			return
+		with self.lock:
+			if version != self.version:
+				self.build(conn, version)
+
+	def products(self, sic, employees, products=None, limit=None):
+		"""Return (product_id, description, demand) for a location, highest demand first.
+		products restricts the result to a subset of product ids and limit keeps only the top N."""
+		if products is not None:
+			products = set(products)
+
+		results = []
+		for product_id, description, ratio in self.sics.get(sic, []):
+			if products is not None and product_id not in products:
+				continue
+			results.append((product_id, description, int(ratio * employees)))
+			if limit and len(results) >= limit:
+				break
+		return results
+
+
+# how much a match in each product field counts towards its search rank
+SEARCH_FIELD_WEIGHTS = {"description": 3, "category": 2, "extended": 1}
+
+# longest prefix kept in the prefix index, longer search terms are checked against the product's words
+MAX_PREFIX = 12
+
+# trigram similarity (shared / all trigrams) a word needs to count as a fuzzy match for a search term
+TRIGRAM_THRESHOLD = 0.3
+
+
+def search_words(text):
+	"""Split text into lower case alphanumeric words"""
+	if not text:
+		return []
+	return "".join(c if c.isalnum() else " " for c in text.lower()).split()
+
+
+def trigrams(word):
+	padded = "  " + word + " "
+	return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class ProductSearchIndex(object):
+	"""In memory prefix and trigram index over product description, category and extended description.
+
+	Every word of the query has to match a product, either as the prefix of one of its words or failing
+	that as a close trigram match to one of them, so a search can be answered while the user is still
+	typing. Products are ranked by which fields matched. Rebuilt whenever it is asked for a different
+	model version."""
+
+	query = """
+		select product_id, description, type, category, extended from products
+		where category is not NULL
+		order by category, description
+		"""
+
+	def __init__(self):
+		self.version = None
+		self.products = []
+		self.words = {}
+		self.prefixes = {}
+		self.grams = {}
+		self.lock = threading.Lock()
+
+	def build(self, conn, version):
+		cur = conn.cursor()
+		cur.execute(ProductSearchIndex.query)
+		self.load(cur, version)
+		cur.close()
+
+	def load(self, rows, version):
+		"""Build the index from rows returned by query"""
+		products = []
+		# word -> {product: best field weight}, prefix -> {product: best field weight}, trigram -> words
+		words = {}
+		prefixes = {}
+		grams = {}
+		for row in rows:
+			doc = len(products)
+			products.append({
+				"productId":row[0],
+				"description":row[1],
+				"type":row[2],
+				"category":row[3],
+				"extended":row[4]
+				})
+
+			for field, weight in SEARCH_FIELD_WEIGHTS.items():
+				for word in search_words(products[-1][field]):
+					docs = words.setdefault(word, {})
+					docs[doc] = max(weight, docs.get(doc, 0))
+					for i in range(1, min(len(word), MAX_PREFIX) + 1):
+						docs = prefixes.setdefault(word[:i], {})
+						docs[doc] = max(weight, docs.get(doc, 0))
+
+		for word in words:
+			for gram in trigrams(word):
+				grams.setdefault(gram, []).append(word)
+
+		self.products = products
+		self.words = words
+		self.prefixes = prefixes
+		self.grams = grams
+		self.version = version
+
+	def ensure(self, conn, version):
+		"""Rebuild the index from conn if it was built from a different model version"""
+		if version == self.version:
+			return
+		with self.lock:
+			if version != self.version:
+				self.build(conn, version)
+
+	def _prefix_matches(self, term):
+		if len(term) > MAX_PREFIX:
+			matches = {}
+			for word in self.words:
+				if word.startswith(term):
+					for doc, weight in self.words[word].items():
+						matches[doc] = max(weight, matches.get(doc, 0))
+		else:
+			matches = dict(self.prefixes.get(term, {}))
+
+		# a whole word match ranks above a prefix
+		for doc, weight in self.words.get(term, {}).items():
+			matches[doc] += weight
+		return matches
+
+	def _trigram_matches(self, term):
+		term_grams = trigrams(term)
+		hits = {}
+		for gram in term_grams:
+			for word in self.grams.get(gram, ()):
+				hits[word] = hits.get(word, 0) + 1
+
+		matches = {}
+		for word, count in hits.items():
+			similarity = float(count) / len(term_grams | trigrams(word))
+			if similarity >= TRIGRAM_THRESHOLD:
+				for doc, weight in self.words[word].items():
+					matches[doc] = max(similarity * weight, matches.get(doc, 0))
+		return matches
+
+	def search(self, q, limit=10):
+		"""Return up to limit products matching every word of q, best match first"""
+		scores = None
+		for term in search_words(q):
+			matches = self._prefix_matches(term) or self._trigram_matches(term)
+			if scores is None:
+				scores = matches
+			else:
+				scores = dict((doc, scores[doc] + score) for doc, score in matches.items() if doc in scores)
+			if not scores:
+				return []
+
+		if not scores:
+			return []
+		ranked = heapq.nsmallest(limit, scores.items(), key=lambda ds: (-ds[1], ds[0]))
+		return [self.products[doc] for doc, score in ranked]
@@ -0,0 +1,100 @@
+import threading
+import psycopg2
+from indexes import SicProductIndex, ProductSearchIndex
+
+
+class ReferenceData(object):
+	"""The small, read-only tables every worker needs: products, ratios, sic and naics codes and the geo hierarchy.
+
+	Loaded once in the gunicorn master when preloading so forked workers share it copy-on-write, or by a
+	worker the first time it needs it otherwise. ImiModel uses it to validate inputs without a query per
+	product or filter. It only knows what exists, anything it doesn't know about is checked against the
+	database as before."""
+
+	def __init__(self):
+		self.version = None
+		self.sic_rows = []
+		self.product_rows = []
+		self.ratio_products = set()
+		self.sic = set()
+		self.naics = set()
+		self.geo = set()
+		# planner row estimates of the locations tables and the number of places at each geo level, used to estimate query cost
+		self.table_rows = {}
+		self.places = {}
+		self.lock = threading.Lock()
+
+	def load(self, conn, version):
+		cur = conn.cursor()
+
+		cur.execute(SicProductIndex.query)
+		sic_rows = cur.fetchall()
+		cur.execute(ProductSearchIndex.query)
+		product_rows = cur.fetchall()
+
+		cur.execute("select distinct product_id from ratios")
+		ratio_products = set(row[0] for row in cur)
+		cur.execute("select sic from sic")
+		sic = set(str(row[0]) for row in cur)
+		cur.execute("select naics from naics")
+		naics = set(str(row[0]) for row in cur)
+
+		# every combination geo_filter_to_sql can match on, see has_geo
+		cur.execute("select distinct nation, region, state, state_abbrev, msa, county, county_fips from geo")
+		geo = set()
+		places = {"nation": set(), "region": set(), "state": set(), "msa": set(), "county": set()}
+		for nation, region, state, state_abbrev, msa, county, county_fips in cur:
+			places["nation"].add(nation)
+			places["region"].add((nation, region))
+			places["state"].add((nation, state))
+			places["msa"].add((nation, msa))
+			places["county"].add((nation, state, county))
+			geo.add((nation,))
+			geo.add((nation, "region", region))
+			geo.add((nation, "state", state))
+			geo.add((nation, "state_abbrev", state_abbrev))
+			geo.add((nation, "msa", msa))
+			geo.add((nation, "county", state, county))
+			geo.add((nation, "county_fips", state_abbrev, county_fips))
+		places = dict((level, len(p)) for level, p in places.items())
+
+		try:
+			cur.execute("select relname, reltuples from pg_class where relname like 'locations%' and relkind in ('r', 'm')")
+			table_rows = dict((name, int(rows)) for name, rows in cur if rows > 0)
+		except psycopg2.Error:
+			# no statistics, ImiModel falls back to its constants
+			conn.rollback()
+			table_rows = {}
+		cur.close()
+
+		with self.lock:
+			self.sic_rows = sic_rows
+			self.product_rows = product_rows
+			self.ratio_products = ratio_products
+			self.sic = sic
+			self.naics = naics
+			self.geo = geo
+			self.places = places
+			self.table_rows = table_rows
+			self.version = version
+
+	def has_product(self, product_id):
+		return product_id in self.ratio_products
+
+	def has_seg(self, seg_type, code):
+		if seg_type == "naics":
+			return str(code) in self.naics
+		return str(code) in self.sic
+
+	def has_geo(self, f):
+		"""True if a single geo filter is known to match, checked in the same order as geo_filter_to_sql"""
+		if "nation" in f and "county" in f:
+			return (f["nation"], "county", f.get("state"), f["county"]) in self.geo
+		elif "nation" in f and "county_fips" in f:
+			return (f["nation"], "county_fips", f.get("state_abbrev"), f["county_fips"]) in self.geo
+		for key in ["msa", "state", "state_abbrev", "region"]:
+			if "nation" in f and key in f:
+				return (f["nation"], key, f[key]) in self.geo
+		if "nation" in f:
+			return (f["nation"],) in self.geo
+		return False
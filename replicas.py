@@ -0,0 +1,161 @@
+import os
+import time
+import random
+import logging
+import threading
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+logger = logging.getLogger(__name__)
+
+QUERY_CLASSES = ["lookup", "aggregation"]
+
+
+def putconn(pool, conn):
+	"""Return a connection to a psycopg2 pool, rolling back anything left open. A connection that can't be rolled back is closed instead of handed to the next user"""
+	broken = bool(conn.closed)
+	if not broken:
+		try:
+			conn.rollback()
+		except psycopg2.Error:
+			broken = True
+	pool.putconn(conn, close=broken)
+
+
+class Replica(object):
+
+	def __init__(self, url, weight=1, query_classes=None):
+		self.url = url
+		self.weight = weight
+		self.query_classes = query_classes or QUERY_CLASSES
+		self.healthy = False
+		self.version = None
+
+
+def parse_replicas(value=None):
+	"""Parse a replica list like "aggregation:3:postgres://r1/imi,lookup:1:postgres://r2/imi" into Replicas.
+	The query class can be lookup, aggregation or all."""
+	replicas = []
+	if not value:
+		return replicas
+	for entry in value.split(","):
+		parts = entry.strip().split(":", 2)
+		if len(parts) != 3 or parts[0] not in QUERY_CLASSES + ["all"]:
+			raise Exception("replica {}".format(entry))
+		query_classes = QUERY_CLASSES if parts[0] == "all" else [parts[0]]
+		replicas.append(Replica(parts[2], weight=int(parts[1]), query_classes=query_classes))
+	return replicas
+
+
+class ReplicaRouter(object):
+	"""Pick a read replica for each class of query.
+
+	A background thread checks every replica each interval seconds. A replica is healthy if it answers
+	and its version table matches the primary's, so one still loading or serving an old model is skipped.
+	Healthy replicas are chosen at random in proportion to their weight. Each worker keeps a pool of up
+	to pool_size connections per replica."""
+
+	def __init__(self, primary_url, replicas=None, interval=10, connect_timeout=2, pool_size=4):
+		self.primary_url = primary_url
+		self.replicas = replicas or []
+		self.interval = interval
+		self.connect_timeout = connect_timeout
+		self.pool_size = pool_size
+		self.primary_version = None
+		self.pools = {}
+		self.lock = threading.Lock()
+		self.pid = None
+
+	def _dsn(self, url):
+		separator = "&" if "?" in url else "?"
+		return "{}{}connect_timeout={}".format(url, separator, self.connect_timeout)
+
+	def _version(self, url):
+		conn = psycopg2.connect(self._dsn(url))
+		try:
+			cur = conn.cursor()
+			cur.execute("select version from version;")
+			return cur.fetchone()[0]
+		finally:
+			conn.close()
+
+	def check(self):
+		"""Refresh the primary's version and the health of every replica"""
+		try:
+			self.primary_version = self._version(self.primary_url)
+		except psycopg2.Error as e:
+			logger.warning("could not check primary: {}".format(e))
+			return
+
+		for r in self.replicas:
+			try:
+				r.version = self._version(r.url)
+				healthy = r.version == self.primary_version
+			except psycopg2.Error:
+				r.version = None
+				healthy = False
+			if healthy != r.healthy:
+				logger.info("replica {} is now {}".format(r.url.split("@")[-1], "healthy" if healthy else "unhealthy"))
+			r.healthy = healthy
+
+	def _run(self):
+		while True:
+			time.sleep(self.interval)
+			self.check()
+
+	def start(self):
+		"""Start health checking in this process. Threads don't survive a fork so each worker starts its own."""
+		with self.lock:
+			if self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			# pools inherited from the parent share its sockets and can't be used after a fork
+			self.pools = {}
+		self.check()
+		t = threading.Thread(target=self._run)
+		t.daemon = True
+		t.start()
+
+	def choose(self, query_class=None):
+		"""Return the url of a healthy replica for this class of query, or None to use the primary"""
+		if not self.replicas:
+			return None
+		self.start()
+
+		candidates = [r for r in self.replicas if r.healthy and query_class in r.query_classes]
+		total = sum(r.weight for r in candidates)
+		if total <= 0:
+			return None
+
+		pick = random.uniform(0, total)
+		for r in candidates:
+			pick -= r.weight
+			if pick <= 0:
+				return r.url
+		return candidates[-1].url
+
+	def replica_version(self, url):
+		"""The model version the last check found on a replica"""
+		for r in self.replicas:
+			if r.url == url:
+				return r.version
+		return None
+
+	def getconn(self, url):
+		"""Borrow a connection to a replica from this worker's pool for it. Raises PoolError if the pool is full"""
+		with self.lock:
+			pool = self.pools.get(url)
+			if pool is None:
+				pool = ThreadedConnectionPool(0, self.pool_size, self._dsn(url))
+				self.pools[url] = pool
+		return pool.getconn()
+
+	def putconn(self, url, conn):
+		"""Return a replica connection to its pool, rolling back anything left open"""
+		putconn(self.pools[url], conn)
+
+	def mark_unhealthy(self, url):
+		"""Stop using a replica until the next check finds it healthy again"""
+		for r in self.replicas:
+			if r.url == url:
+				r.healthy = False
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+
+# how often a worker waiting on another worker's result checks the lock, in seconds
+POLL_INTERVAL = 0.01
+
+
+class FlightError(Exception):
+	"""Raised to callers that waited on another caller's execution which failed or took too long"""
+
+	def __init__(self, message, retry_after=None, kind=None):
+		Exception.__init__(self, message)
+		self.retry_after = retry_after
+		# class name of the exception the other worker's execution raised
+		self.kind = kind
+
+
+class _Call(object):
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight(object):
+	"""Run a function once for concurrent callers with the same key and share its result.
+
+	Within a worker the first caller runs the function and the others wait for it. With shared_dir set
+	the same happens across workers on the host: the worker holding the key's lock file runs it and
+	writes the result to a file the others read once the lock is released. Waiters give up after timeout
+	seconds, so a caller never takes much longer than that, and a failure is raised to every waiter as a
+	FlightError."""
+
+	def __init__(self, timeout=30, shared_dir=None):
+		self.timeout = timeout
+		self.shared_dir = shared_dir
+		self.calls = {}
+		self.lock = threading.Lock()
+		self.pruned = 0
+		if shared_dir and not os.path.isdir(shared_dir):
+			try:
+				os.makedirs(shared_dir, 0o700)
+			except OSError:
+				# another worker created it first
+				if not os.path.isdir(shared_dir):
+					raise
+
+	def do(self, key, fn):
+		with self.lock:
+			call = self.calls.get(key)
+			leader = call is None
+			if leader:
+				call = _Call()
+				self.calls[key] = call
+
+		if not leader:
+			call.done.wait(self.timeout)
+			if not call.done.is_set():
+				raise FlightError("timed out waiting for {}".format(key), retry_after=1)
+			if call.error is not None:
+				raise call.error
+			return call.result
+
+		try:
+			call.result = self._run(key, fn)
+		except Exception as e:
+			call.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.done.set()
+		return call.result
+
+	def _run(self, key, fn):
+		if not self.shared_dir:
+			return fn()
+
+		digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+		result_path = os.path.join(self.shared_dir, digest + ".json")
+		lock_path = os.path.join(self.shared_dir, digest + ".lock")
+
+		started = time.time()
+		fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+		# keep the lock file's mtime recent while it is in use so _prune leaves it alone
+		os.utime(lock_path, None)
+		try:
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError:
+				# another worker is running it, wait for it to finish and use its result
+				while True:
+					time.sleep(POLL_INTERVAL)
+					try:
+						fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+						break
+					except IOError:
+						if time.time() - started >= self.timeout:
+							raise FlightError("timed out waiting for {}".format(key), retry_after=1)
+
+				shared = self._read(result_path)
+				if shared is None or shared["finished"] < started:
+					# the other worker died without a result, running it now could take us past timeout so let the caller retry
+					raise FlightError("no result for {}".format(key), retry_after=1)
+				if "error" in shared:
+					raise FlightError(shared["error"], retry_after=shared.get("retry_after"), kind=shared.get("kind"))
+				return shared["result"]
+
+			try:
+				result = fn()
+			except Exception as e:
+				self._write(result_path, {"error": str(e), "retry_after": getattr(e, "retry_after", None), "kind": e.__class__.__name__})
+				raise
+			self._write(result_path, {"result": result})
+			return result
+		finally:
+			os.close(fd)
+
+	def _read(self, path):
+		try:
+			with open(path) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return None
+
+	def _write(self, path, shared):
+		shared["finished"] = time.time()
+		tmp = "{}.{}".format(path, os.getpid())
+		with open(tmp, "w") as f:
+			json.dump(shared, f)
+		os.rename(tmp, path)
+		self._prune()
+
+	def _prune(self):
+		"""Remove result and lock files nobody can be waiting for any more, at most once a minute"""
+		now = time.time()
+		if now - self.pruned < 60:
+			return
+		self.pruned = now
+		for name in os.listdir(self.shared_dir):
+			path = os.path.join(self.shared_dir, name)
+			try:
+				if now - os.path.getmtime(path) <= 2 * self.timeout:
+					continue
+				if name.endswith(".json"):
+					os.remove(path)
+				elif name.endswith(".lock"):
+					# only remove a lock file nobody holds
+					fd = os.open(path, os.O_RDWR)
+					try:
+						fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+						os.remove(path)
+					except IOError:
+						pass
+					finally:
+						os.close(fd)
+			except OSError:
+				# removed by another worker
+				pass
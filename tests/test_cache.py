@@ -0,0 +1,43 @@
+import unittest
+
+from cache import ResultCache, result_rows
+
+
+class ResultCacheTest(unittest.TestCase):
+
+	def test_result_rows_counts_nested_lists(self):
+		self.assertEqual(result_rows({"results": [[1, 2], [3, 4]], "total": 10}), 6)
+		self.assertEqual(result_rows({"children": [{"children": [1, 2]}, {"children": []}]}), 4)
+		self.assertEqual(result_rows("text"), 0)
+
+	def test_large_results_are_not_cached(self):
+		cache = ResultCache(max_entry_rows=5)
+		cache.put("v1", "small", {"results": [1, 2]})
+		cache.put("v1", "large", {"results": list(range(6))})
+		self.assertEqual(cache.get("small"), {"results": [1, 2]})
+		self.assertEqual(cache.get("large"), None)
+
+	def test_least_recently_used_evicted_over_max_rows(self):
+		cache = ResultCache(max_rows=10)
+		cache.put("v1", "a", {"results": list(range(4))})
+		cache.put("v1", "b", {"results": list(range(4))})
+		cache.get("a")
+		cache.put("v1", "c", {"results": list(range(4))})
+		self.assertEqual(cache.get("b"), None)
+		self.assertNotEqual(cache.get("a"), None)
+		self.assertEqual(cache.rows, 8)
+
+	def test_rows_are_released_when_a_version_is_dropped(self):
+		cache = ResultCache(max_rows=10)
+		cache.put("v1", "a", {"results": list(range(4))})
+		cache.warm("v2")
+		cache.put("v2", "a", {"results": list(range(3))})
+		self.assertEqual(cache.rows, 7)
+		self.assertEqual(cache.get("a"), {"results": list(range(4))})
+		cache.promote("v2")
+		self.assertEqual(cache.rows, 3)
+		self.assertEqual(cache.get("a"), {"results": list(range(3))})
+
+
+if __name__ == '__main__':
+	unittest.main()
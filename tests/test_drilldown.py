@@ -0,0 +1,137 @@
+import unittest
+
+import imimodel
+
+
+class FakeCursor(object):
+
+	def __init__(self, conn):
+		self.conn = conn
+		self.rows = []
+
+	def mogrify(self, query, params):
+		return query % tuple("'{}'".format(p) for p in params)
+
+	def execute(self, query, params=None):
+		self.conn.queries.append(query)
+		self.rows = self.conn.rows if "sum(l.employees*r.ratio)" in query else []
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def close(self):
+		pass
+
+
+class FakeConnection(object):
+	"""Answers the drill-down query with canned rows: the place columns down to the finest level, then demand and companies"""
+
+	closed = 0
+
+	def __init__(self, rows):
+		self.rows = rows
+		self.queries = []
+
+	def cursor(self):
+		return FakeCursor(self)
+
+	def rollback(self):
+		pass
+
+
+class FakePool(object):
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def getconn(self):
+		return self.conn
+
+	def putconn(self, conn, close=False):
+		pass
+
+
+class KnowsEverything(object):
+	"""Reference data that accepts every product and filter so validation doesn't query"""
+
+	def has_product(self, product_id):
+		return True
+
+	def has_geo(self, f):
+		return True
+
+	def has_seg(self, seg_type, code):
+		return True
+
+
+COUNTY_ROWS = [
+	# nation, region, state, state_abbrev, county, fips, demand, companies
+	("US", "West", "California", "CA", "Los Angeles", "06037", 100.4, 10),
+	("US", "West", "California", "CA", "Orange", "06059", 50.4, 5),
+	("US", "West", "Oregon", "OR", "Lane", "41039", 0.4, 1),
+	("US", "West", "Oregon", "OR", "Benton", "41003", 0.4, 1),
+]
+
+
+class DemandDrilldownTest(unittest.TestCase):
+
+	def drilldown(self, rows, levels, geo_filter="US"):
+		self.conn = FakeConnection(rows)
+		db = imimodel.ImiModel(pool=FakePool(self.conn), reference=KnowsEverything())
+		return db.demand_drilldown(levels=levels, geo_filter=geo_filter, products=["p1"])
+
+	def test_nesting_and_per_level_totals(self):
+		result = self.drilldown(COUNTY_ROWS, ["nation", "state", "county"])
+		self.assertEqual(result["levels"], ["nation", "state", "county"])
+		self.assertEqual((result["demand"], result["companies"]), (152, 17))
+
+		nation, = result["children"]
+		self.assertEqual((nation["level"], nation["name"], nation["demand"], nation["companies"]), ("nation", "US", 152, 17))
+
+		california, oregon = nation["children"]
+		self.assertEqual((california["name"], california["abbrev"], california["demand"], california["companies"]), ("California", "CA", 151, 15))
+		self.assertEqual([(c["name"], c["fips"], c["demand"]) for c in california["children"]], [("Los Angeles", "06037", 100), ("Orange", "06059", 50)])
+
+		# rounded after summing, so a state matches what grouping /1/demand by state returns rather than the sum of its rounded counties
+		self.assertEqual((oregon["name"], oregon["demand"], oregon["companies"]), ("Oregon", 1, 2))
+		self.assertEqual([c["demand"] for c in oregon["children"]], [0, 0])
+		self.assertEqual(oregon["children"][0]["children"], [])
+
+	def test_levels_are_ordered_and_deduplicated(self):
+		result = self.drilldown(COUNTY_ROWS, ["county", "nation", "county"])
+		self.assertEqual(result["levels"], ["nation", "county"])
+
+		# the query still groups by state so counties with the same name in different states stay apart
+		self.assertTrue("g.state_abbrev" in self.conn.queries[-1])
+		nation, = result["children"]
+		counties = [(c["level"], c["name"]) for c in nation["children"]]
+		self.assertEqual(counties[:2], [("county", "Los Angeles"), ("county", "Orange")])
+		self.assertEqual(sorted(counties[2:]), [("county", "Benton"), ("county", "Lane")])
+
+	def test_only_groups_down_to_the_finest_level(self):
+		rows = [("US", "West", "California", "CA", 150.8, 15), ("US", "West", "Oregon", "OR", 0.8, 2)]
+		result = self.drilldown(rows, ["state", "nation"])
+		self.assertEqual(result["levels"], ["nation", "state"])
+		self.assertTrue("g.county" not in self.conn.queries[-1])
+		self.assertTrue("locations_state " in self.conn.queries[-1])
+		self.assertEqual([(s["name"], s["demand"]) for s in result["children"][0]["children"]], [("California", 151), ("Oregon", 1)])
+
+	def test_geo_filter_finer_than_the_finest_level(self):
+		rows = [("US", "West", "California", "CA", 100.4, 10)]
+		result = self.drilldown(rows, ["nation", "state"], geo_filter="US.CA.037")
+
+		# a county filter has to read the county extent even though the result stops at states
+		query = self.conn.queries[-1]
+		self.assertTrue("locations_county " in query)
+		self.assertTrue("g.county_fips='037'" in query)
+		self.assertTrue("g.county," not in query)
+		state, = result["children"][0]["children"]
+		self.assertEqual((state["name"], state["demand"], state["children"]), ("California", 100, []))
+
+	def test_unknown_level(self):
+		with self.assertRaises(Exception):
+			self.drilldown(COUNTY_ROWS, ["nation", "city"])
+
+
+if __name__ == '__main__':
+	unittest.main()
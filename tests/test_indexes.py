@@ -0,0 +1,90 @@
+import unittest
+
+from indexes import SicProductIndex, ProductSearchIndex, MAX_PREFIX
+
+
+class SicProductIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index = SicProductIndex()
+		# rows come back from SicProductIndex.query sorted by sic then ratio descending
+		self.index.load([
+			(100, "p1", "Paper", 0.5),
+			(100, "p2", "Toner", 0.25),
+			(100, "p3", "Desks", 0.1),
+			(200, "p2", "Toner", 1.0),
+		], "v1")
+
+	def test_products_ranked_by_demand(self):
+		self.assertEqual(self.index.products(100, 10), [("p1", "Paper", 5), ("p2", "Toner", 2), ("p3", "Desks", 1)])
+
+	def test_products_top_n(self):
+		self.assertEqual(self.index.products(100, 10, limit=2), [("p1", "Paper", 5), ("p2", "Toner", 2)])
+
+	def test_products_subset(self):
+		self.assertEqual(self.index.products(100, 10, products=["p3", "p2"]), [("p2", "Toner", 2), ("p3", "Desks", 1)])
+		self.assertEqual(self.index.products(100, 10, products=["p3", "p2"], limit=1), [("p2", "Toner", 2)])
+		self.assertEqual(self.index.products(100, 10, products=[]), [])
+
+	def test_unknown_sic(self):
+		self.assertEqual(self.index.products(999, 10), [])
+
+
+class ProductSearchIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index = ProductSearchIndex()
+		# product_id, description, type, category, extended
+		self.index.load([
+			("p1", "Printer paper", "consumable", "Office supplies", "Copy paper in reams"),
+			("p2", "Paperback books", "goods", "Books", None),
+			("p3", "Office chairs", "goods", "Furniture", "Ergonomic office seating"),
+			("p4", "Toner cartridges", "consumable", "Office supplies", "Laser printer toner"),
+			("p5", "Telecommunications services", "service", "Services", None),
+		], "v1")
+
+	def ids(self, q, limit=10):
+		return [p["productId"] for p in self.index.search(q, limit=limit)]
+
+	def test_empty_query(self):
+		self.assertEqual(self.index.search(""), [])
+		self.assertEqual(self.index.search(None), [])
+		self.assertEqual(self.index.search(" ,. "), [])
+
+	def test_prefix_matches_while_typing(self):
+		self.assertEqual(self.ids("tone"), ["p4"])
+		self.assertEqual(sorted(self.ids("pap")), ["p1", "p2"])
+
+	def test_whole_word_ranks_above_prefix(self):
+		# "paper" is a whole word of p1's description and only a prefix of p2's "paperback"
+		self.assertEqual(self.ids("paper"), ["p1", "p2"])
+
+	def test_field_weights(self):
+		# "office" is in p3's description but only the category or extended description of p1 and p4
+		self.assertEqual(self.ids("office")[0], "p3")
+
+	def test_terms_longer_than_max_prefix(self):
+		term = "telecommunications"
+		self.assertTrue(len(term) > MAX_PREFIX)
+		self.assertEqual(self.ids(term), ["p5"])
+		self.assertEqual(self.ids(term[:MAX_PREFIX + 2]), ["p5"])
+
+	def test_trigram_fallback_for_typos(self):
+		self.assertEqual(self.ids("cartrdges"), ["p4"])
+		self.assertEqual(self.ids("xyzzy"), [])
+
+	def test_every_term_has_to_match(self):
+		self.assertEqual(self.ids("office toner"), ["p4"])
+		self.assertEqual(self.ids("paper chairs"), [])
+
+	def test_limit(self):
+		self.assertEqual(len(self.ids("o", limit=2)), 2)
+		self.assertEqual(self.ids("paper", limit=1), ["p1"])
+
+	def test_ties_keep_load_order(self):
+		self.assertEqual(self.ids("consumable"), [])
+		self.assertEqual(self.ids("supplies"), ["p1", "p4"])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,161 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from singleflight import SingleFlight, FlightError
+
+
+class Expensive(Exception):
+	pass
+
+
+class SingleFlightTest(unittest.TestCase):
+
+	def setUp(self):
+		self.shared_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.shared_dir)
+
+	def call_in_threads(self, flight, key, fn, count=5):
+		results = []
+		errors = []
+
+		def call():
+			try:
+				results.append(flight.do(key, fn))
+			except Exception as e:
+				errors.append(e)
+
+		threads = [threading.Thread(target=call) for i in range(count)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return results, errors
+
+	def test_concurrent_callers_share_one_execution(self):
+		runs = []
+
+		def fn():
+			runs.append(1)
+			time.sleep(0.2)
+			return 42
+
+		results, errors = self.call_in_threads(SingleFlight(timeout=5), "key", fn)
+		self.assertEqual(errors, [])
+		self.assertEqual(results, [42] * 5)
+		self.assertEqual(len(runs), 1)
+
+	def test_error_is_raised_to_waiters(self):
+		def fn():
+			time.sleep(0.2)
+			raise Expensive("too slow")
+
+		results, errors = self.call_in_threads(SingleFlight(timeout=5), "key", fn)
+		self.assertEqual(results, [])
+		self.assertEqual(len(errors), 5)
+		self.assertTrue(all(isinstance(e, Expensive) for e in errors))
+
+	def test_waiters_time_out(self):
+		release = threading.Event()
+		flight = SingleFlight(timeout=0.1)
+		leader = threading.Thread(target=flight.do, args=("key", lambda: release.wait(5)))
+		leader.start()
+		time.sleep(0.05)
+		try:
+			with self.assertRaises(FlightError) as raised:
+				flight.do("key", lambda: None)
+			self.assertEqual(raised.exception.retry_after, 1)
+		finally:
+			release.set()
+			leader.join()
+
+	def test_different_keys_run_concurrently(self):
+		flight = SingleFlight(timeout=5, shared_dir=self.shared_dir)
+		started = dict((key, threading.Event()) for key in range(60))
+		overlapped = []
+
+		def fn(key):
+			started[key].set()
+			# every other key must be able to start while this one is still running
+			overlapped.append(all(e.wait(2) for e in started.values()))
+			return key
+
+		threads = [threading.Thread(target=flight.do, args=(key, lambda key=key: fn(key))) for key in started]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(overlapped, [True] * len(started))
+
+	def run_in_worker(self, key, fn):
+		"""Run key in a forked worker with its own SingleFlight sharing the directory, returns its pid"""
+		pid = os.fork()
+		if pid == 0:
+			try:
+				SingleFlight(timeout=5, shared_dir=self.shared_dir).do(key, fn)
+			except Exception:
+				pass
+			finally:
+				os._exit(0)
+		# give the worker time to take the lock
+		time.sleep(0.2)
+		return pid
+
+	def test_workers_share_result(self):
+		runs = []
+		pid = self.run_in_worker("key", lambda: time.sleep(0.5) or "from the other worker")
+		try:
+			result = SingleFlight(timeout=5, shared_dir=self.shared_dir).do("key", lambda: runs.append(1))
+		finally:
+			os.waitpid(pid, 0)
+		self.assertEqual(result, "from the other worker")
+		self.assertEqual(runs, [])
+
+	def test_workers_share_errors(self):
+		def fn():
+			time.sleep(0.5)
+			raise Expensive("too slow")
+
+		pid = self.run_in_worker("key", fn)
+		try:
+			with self.assertRaises(FlightError) as raised:
+				SingleFlight(timeout=5, shared_dir=self.shared_dir).do("key", lambda: None)
+		finally:
+			os.waitpid(pid, 0)
+		self.assertEqual(raised.exception.kind, "Expensive")
+
+	def test_worker_waits_time_out(self):
+		pid = self.run_in_worker("key", lambda: time.sleep(1))
+		try:
+			with self.assertRaises(FlightError) as raised:
+				SingleFlight(timeout=0.2, shared_dir=self.shared_dir).do("key", lambda: None)
+		finally:
+			os.waitpid(pid, 0)
+		self.assertEqual(raised.exception.retry_after, 1)
+
+	def test_worker_dying_without_a_result(self):
+		def fn():
+			time.sleep(0.5)
+			os._exit(1)
+
+		pid = self.run_in_worker("key", fn)
+		try:
+			with self.assertRaises(FlightError) as raised:
+				SingleFlight(timeout=5, shared_dir=self.shared_dir).do("key", lambda: "ran it ourselves")
+		finally:
+			os.waitpid(pid, 0)
+		self.assertEqual(raised.exception.retry_after, 1)
+
+	def test_result_is_not_reused_after_it_finished(self):
+		flight = SingleFlight(timeout=5, shared_dir=self.shared_dir)
+		self.assertEqual(flight.do("key", lambda: 1), 1)
+		self.assertEqual(flight.do("key", lambda: 2), 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,117 @@
+import time
+import logging
+import threading
+from Queue import Queue, Empty
+
+logger = logging.getLogger(__name__)
+
+
+class Warmer(object):
+	"""Notice when the model fingerprint changes and refill the cache for the new version in the background.
+
+	The most popular recent requests from the sketch are replayed against the database by a few threads.
+	Until the replayed requests cover `coverage` of that popularity the cache keeps serving the old version."""
+
+	def __init__(self, cache, sketch, connect, replay, prepare=None, keys=200, concurrency=2, coverage=0.8, interval=30):
+		self.cache = cache
+		self.sketch = sketch
+		# connect() returns a new ImiModel, replay(db, key, version) recomputes the result for a request key
+		self.connect = connect
+		self.replay = replay
+		# optional prepare(db, version) run once before replaying, to reload anything else tied to the version
+		self.prepare = prepare
+		self.keys = keys
+		self.concurrency = concurrency
+		self.coverage = coverage
+		self.interval = interval
+		self.version = None
+		self.checked = 0
+		self.lock = threading.Lock()
+
+	def poll(self, get_db):
+		"""Return the current fingerprint, checking it at most once every interval seconds. get_db() returns an ImiModel and is only called when a check is due"""
+		if self.version is None or time.time() - self.checked >= self.interval:
+			self.notice(get_db().fingerprint())
+		return self.version
+
+	def notice(self, version):
+		"""Called with the current fingerprint, starts warming if it has changed"""
+		self.checked = time.time()
+		with self.lock:
+			if version == self.version:
+				return
+			previous = self.version
+			self.version = version
+
+		if previous is None or self.cache.active is None:
+			# nothing cached yet so there is nothing to keep serving while we warm
+			self.cache.promote(version)
+			return
+
+		logger.info("model version changed from {} to {}, warming cache".format(previous, version))
+		self.cache.warm(version)
+		t = threading.Thread(target=self.warm, args=(version,))
+		t.daemon = True
+		t.start()
+
+	def warm(self, version):
+		if self.prepare:
+			db = None
+			try:
+				db = self.connect()
+				self.prepare(db, version)
+			except Exception as e:
+				logger.warning("could not prepare version {}: {}".format(version, e))
+			finally:
+				if db:
+					db.close()
+
+		popular = self.sketch.top(self.keys)
+		total = sum(count for key, count in popular)
+		if total == 0:
+			self.cache.promote(version)
+			return
+
+		todo = Queue()
+		for p in popular:
+			todo.put(p)
+		progress = {"warmed": 0}
+		progress_lock = threading.Lock()
+
+		def worker():
+			try:
+				db = self.connect()
+			except Exception as e:
+				logger.warning("could not connect to warm version {}: {}".format(version, e))
+				return
+			try:
+				while self.version == version:
+					try:
+						key, count = todo.get_nowait()
+					except Empty:
+						return
+					if not self.cache.has(version, key):
+						try:
+							self.cache.put(version, key, self.replay(db, key, version))
+						except Exception as e:
+							logger.warning("could not warm {}: {}".format(key, e))
+							continue
+					with progress_lock:
+						progress["warmed"] += count
+						if progress["warmed"] >= self.coverage * total:
+							self.cache.promote(version)
+			finally:
+				db.close()
+
+		threads = [threading.Thread(target=worker) for i in range(self.concurrency)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		for t in threads:
+			t.join()
+
+		if self.version == version and self.cache.active != version:
+			# warming finished short of the coverage target, serve the new version anyway rather than stale results forever
+			logger.warning("cache warming for {} reached {} of {}, promoting anyway".format(version, progress["warmed"], total))
+			self.cache.promote(version)
+		logger.info("cache warmed for version {}".format(version))